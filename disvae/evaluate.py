@@ -2,7 +2,6 @@ import os
 import logging
 import math
 import sys
-from functools import reduce
 from collections import defaultdict
 import json
 from timeit import default_timer
@@ -14,8 +13,9 @@ import torch
 from torch import pca_lowrank
 
 from disvae.models.losses import get_loss_f
-from disvae.utils.math import log_density_gaussian
+from disvae.utils.math import logsumexp_gaussian_step
 from disvae.utils.modelIO import save_metadata
+from disvae.utils.prefetch import CUDAPrefetcher
 from disvae.models.linear_model import Classifier
 from disvae.models.linear_model import weight_reset
 
@@ -49,13 +49,19 @@ class Evaluator:
 
     is_progress_bar: bool, optional
         Whether to use a progress bar for training.
+
+    is_compile: bool, optional
+        Whether to compile the classifier of the disentanglement metric and the
+        streamed logsumexp of the entropy estimation with `torch.compile` when
+        evaluating on CUDA.
     """
 
     def __init__(self, model, loss_f,
                  device=torch.device("cpu"),
                  logger=logging.getLogger(__name__),
                  save_dir="results",
-                 is_progress_bar=True, use_wandb = True):
+                 is_progress_bar=True, use_wandb = True,
+                 is_compile=True):
 
         self.device = device
         self.loss_f = loss_f
@@ -65,6 +71,13 @@ class Evaluator:
         self.is_progress_bar = is_progress_bar
         self.logger.info("Testing Device: {}".format(self.device))
         self.use_wandb = use_wandb
+        self.is_compile = is_compile and self.device.type == "cuda" and hasattr(torch, "compile")
+        # fuses the density and the accumulation into a few kernels per tile of the dataset
+        self._logsumexp_gaussian_step = (torch.compile(logsumexp_gaussian_step) if self.is_compile
+                                         else logsumexp_gaussian_step)
+        if self.device.type == "cuda":
+            # the encoder only sees a few fixed batch shapes, so autotuning pays off
+            torch.backends.cudnn.benchmark = True
 
     def __call__(self, data_loader, is_metrics=False, is_losses=True):
         """Compute all test losses.
@@ -110,27 +123,40 @@ class Evaluator:
         ----------
         data_loader: torch.utils.data.DataLoader
         """
-        storer = defaultdict(list)
-        for data, _ in tqdm(dataloader, leave=False, disable=not self.is_progress_bar):
-            data = data.to(self.device)
-
-            try:
-                recon_batch, latent_dist, latent_sample = self.model(data)
-                _ = self.loss_f(data, recon_batch, latent_dist, self.model.training,
-                                storer, latent_sample=latent_sample)
-            except ValueError:
-                # for losses that use multiple optimizers (e.g. Factor)
-                _ = self.loss_f.call_optimize(data, self.model, None, storer)
-
-            losses = {k: sum(v) / len(dataloader) for k, v in storer.items()}
-            return losses
-
-    def compute_metrics(self, dataloader):
+        # running sums and counts of every loss instead of lists of all values
+        storer = defaultdict(float)
+        counts = defaultdict(int)
+        with torch.inference_mode():
+            for data, _ in tqdm(dataloader, leave=False, disable=not self.is_progress_bar):
+                data = data.to(self.device)
+                # the losses append their values for the current batch to this storer
+                batch_storer = defaultdict(list)
+
+                try:
+                    recon_batch, latent_dist, latent_sample = self.model(data)
+                    _ = self.loss_f(data, recon_batch, latent_dist, self.model.training,
+                                    batch_storer, latent_sample=latent_sample)
+                except ValueError:
+                    # for losses that use multiple optimizers (e.g. Factor)
+                    _ = self.loss_f.call_optimize(data, self.model, None, batch_storer)
+
+                for k, v in batch_storer.items():
+                    storer[k] += float(sum(v))
+                    counts[k] += len(v)
+
+        losses = {k: storer[k] / counts[k] for k in storer}
+        return losses
+
+    def compute_metrics(self, dataloader, is_non_linear_metric=False):
         """Compute all the metrics.
 
         Parameters
         ----------
         data_loader: torch.utils.data.DataLoader
+
+        is_non_linear_metric: bool, optional
+            Whether to also compute the disentanglement metric with a non linear
+            classifier. Reuses the PCA and ICA fitted for the linear one.
         """
 
         if self.use_wandb:
@@ -145,9 +171,13 @@ class Evaluator:
             raise ValueError("Dataset needs to have known true factors of variations to compute the metric. This does not seem to be the case for {}".format(type(dataloader.__dict__["dataset"]).__name__))
         
         self.logger.info("Computing the disentanglement metric")
-        accuracies = self._disentanglement_metric(["VAE", "PCA", "ICA"], 300, lat_sizes, lat_imgs, n_epochs=150, dataset_size=1500, hidden_dim=512, use_non_linear=False)
-        #sample size is key for VAE, for sample size 50 only 88% accuarcy, compared to 95 for 200 sample sze
-        #non_linear_accuracies = self._disentanglement_metric(["VAE", "PCA", "ICA"], 50, lat_sizes, lat_imgs, n_epochs=150, dataset_size=5000, hidden_dim=128, use_non_linear=True) #if hidden dim too large -> no training possible
+        method_names = ["VAE", "PCA", "ICA"]
+        methods = self._fit_methods(method_names, lat_imgs)
+        accuracies = self._disentanglement_metric(method_names, 300, lat_sizes, lat_imgs, n_epochs=150, dataset_size=1500, hidden_dim=512, use_non_linear=False, methods=methods)
+        non_linear_accuracies = None
+        if is_non_linear_metric:
+            #sample size is key for VAE, for sample size 50 only 88% accuarcy, compared to 95 for 200 sample sze
+            non_linear_accuracies = self._disentanglement_metric(method_names, 50, lat_sizes, lat_imgs, n_epochs=150, dataset_size=5000, hidden_dim=128, use_non_linear=True, methods=methods) #if hidden dim too large -> no training possible
         if self.use_wandb:
             wandb.log({'VAE_accuracy': accuracies["VAE"], 'PCA_accuracy': accuracies["PCA"], 'ICA_accuracy': accuracies["ICA"]})
             wandb.save("disentanglement_metrics.h5")
@@ -176,98 +206,67 @@ class Evaluator:
         mig = self._mutual_information_gap(sorted_mut_info, lat_sizes, storer=metric_helpers)
         aam = self._axis_aligned_metric(sorted_mut_info, storer=metric_helpers)
 
-        metrics = {'DM': accuracies, 'NLDM': non_linear_accuracies, 'MIG': mig.item(), 'AAM': aam.item()}
+        metrics = {'DM': {k: v.item() for k, v in accuracies.items()},
+                   'NLDM': ({k: v.item() for k, v in non_linear_accuracies.items()}
+                            if non_linear_accuracies is not None else None),
+                   'MIG': mig.item(), 'AAM': aam.item()}
         torch.save(metric_helpers, os.path.join(self.save_dir, METRIC_HELPERS_FILE))
 
         return metrics
 
     #TODO: experiment with different numbers of latent dimensions for different models
     #maybe plot results of three models for different latent dimensions
-    def _disentanglement_metric(self, method_names, sample_size, lat_sizes, imgs, n_epochs=50, dataset_size = 1000, hidden_dim = 256, use_non_linear = False):
-
-        #train models for all concerned methods and stor them in a dict
-        methods = {}
-        for method_name in method_names:
-            if method_name == "VAE":
-                methods["VAE"] = self.model
-
-            elif method_name == "PCA":    
-                self.logger.info("Training PCA...")
-                pca = decomposition.PCA(n_components=self.model.latent_dim, whiten = True)
-                imgs_pca = np.reshape(imgs, (imgs.shape[0], imgs.shape[1]**2))
-                size = 5000
-                if self.use_wandb:
-                    wandb.config["PCA_training_size"] = size
-                idx = np.random.randint(len(imgs_pca), size = size)
-                imgs_pca = imgs_pca[idx, :]       #not enough memory for full dataset -> repeat with random subsets               
-                pca.fit(imgs_pca)
-                methods["PCA"] = pca
-                self.logger.info("Done")
+    def _disentanglement_metric(self, method_names, sample_size, lat_sizes, imgs, n_epochs=50, dataset_size = 1000, hidden_dim = 256, use_non_linear = False, methods=None):
+        """Compute the test accuracy of a classifier predicting the fixed factor of
+        variation from the latent differences of pairs of image sets, for every method.
 
-            elif method_name == "ICA":
-                self.logger.info("Training ICA...")
-                ica = decomposition.FastICA(n_components=self.model.latent_dim)
-                imgs_ica = np.reshape(imgs, (imgs.shape[0], imgs.shape[1]**2))
-                size = 1000
-                if self.use_wandb:
-                    wandb.config["ICA_training_size"] = size
-                idx = np.random.randint(len(imgs_pca), size = size)
-                imgs_ica = imgs_ica[idx, :]       #not enough memory for full dataset -> repeat with random subsets 
-                ica.fit(imgs_ica)
-                methods["ICA"] = ica
-                self.logger.info("Done")
+        Parameters
+        ----------
+        methods: dict, optional
+            Methods already fitted by `_fit_methods`, e.g. to share them across
+            calls. If `None`, the methods in `method_names` are fitted.
+        """
+        if methods is None:
+            methods = self._fit_methods(method_names, imgs)
+        latent_dim = self.model.latent_dim
 
-            else: 
-                raise ValueError("Unknown method : {}".format(method_name))
-        #compute training- and test data for linear classifier      
-        data_train =  self._compute_z_b_diff_y(methods, sample_size, lat_sizes, imgs)
-        data_test =  self._compute_z_b_diff_y(methods, sample_size, lat_sizes, imgs)
-        for method in methods.keys(): 
-            data_train[method][0].unsqueeze_(0)
-            data_test[method][0].unsqueeze_(0)
-       
-        #latent dim = length of z_b_diff for arbitrary method = output dimension of linear classifier
-        latent_dim = next(iter(data_test.values()))[0].shape[1]
+        #convert the images once (no copy) so that the sampled ones are gathered by index
+        cached_imgs = torch.from_numpy(imgs)
 
         #generate dataset_size many training data points and 20% of that test data points
-        for i in range(dataset_size):
-            data = self._compute_z_b_diff_y(methods, sample_size, lat_sizes, imgs)
-            for method in methods:
-                X_train = data_train[method][0]
-                Y_train = data_train[method][1]
-                data_train[method] = torch.cat((X_train, data[method][0].unsqueeze_(0)), 0), torch.cat((Y_train, data[method][1]), 0)
-            
-            if i <= int(dataset_size*0.2):
-                
-                data = self._compute_z_b_diff_y(methods, sample_size, lat_sizes, imgs)
-                for method in methods:
-                    X_test = data_test[method][0]
-                    Y_test = data_test[method][1]
-                    data_test[method] = torch.cat((X_test, data[method][0].unsqueeze_(0)), 0), torch.cat((Y_test, data[method][1]), 0)
+        #the points are i.i.d. so a single pool is generated and split
+        test_size = int(dataset_size * 0.2)
+        data = self._compute_z_b_diff_y(methods, sample_size, lat_sizes, cached_imgs,
+                                        n_points=dataset_size + test_size)
+        data_train, data_test = {}, {}
+        for method, (X, Y) in data.items():
+            (X_train, X_test), (Y_train, Y_test) = X.split(dataset_size), Y.split(dataset_size)
+            data_train[method] = X_train, Y_train
+            data_test[method] = X_test, Y_test
 
         model = Classifier(latent_dim,hidden_dim,len(lat_sizes), use_non_linear)
             
         model.to(self.device)
-        model.train()
+        if self.is_compile:
+            #the classifier is tiny so kernel launches dominate: compile once and replay CUDA graphs
+            model = torch.compile(model, mode="reduce-overhead")
 
         #log softmax with NLL loss 
         criterion = torch.nn.NLLLoss()
-        optim = torch.optim.Adam(model.parameters(), lr=0.01)
-       
+
         test_acc = {}
         for method in methods.keys():
             print(f'Training the classifier for model {method}')
+            model.train()
+            #fresh optimizer state for every method, as the weights are reset
+            optim = torch.optim.Adam(model.parameters(), lr=0.01)
+            #move the data once rather than every epoch (no-op if already on device)
+            X_train, Y_train = (d.to(self.device, non_blocking=True) for d in data_train[method])
+            X_test, Y_test = (d.to(self.device, non_blocking=True) for d in data_test[method])
+
             for e in range(n_epochs):
                 optim.zero_grad()
-                
-                X_train, Y_train = data_train[method]
-                X_train = X_train.to(self.device)
-                Y_train = Y_train.to(self.device)
-                X_test , Y_test = data_test[method]
-                X_test = X_test.to(self.device)
-                Y_test = Y_test.to(self.device)
 
-                
                 scores_train = model(X_train)   
                 loss = criterion(scores_train, Y_train)
                 loss.backward()
@@ -294,73 +293,165 @@ class Evaluator:
 
         return test_acc
 
-    def _compute_z_b_diff_y(self, methods, sample_size, lat_sizes, imgs):
-        """
-        Compute the disentanglement metric score as proposed in the original paper
-        reference: https://github.com/deepmind/dsprites-dataset/blob/master/dsprites_reloading_example.ipynb
+    def _fit_methods(self, method_names, imgs):
+        """Fit the methods to compare in the disentanglement metric.
+
+        Return
+        ------
+        methods: dict
+            Maps "VAE" to the model and "PCA" / "ICA" to a tuple (mean, components)
+            of tensors such that `(x - mean) @ components` projects flattened images.
         """
-        imgs_sampled1, imgs_sampled2, y = self._images_from_data_gen(sample_size, lat_sizes, imgs)
+        #flattened view of the images (no copy) from which PCA and ICA training subsets are drawn
+        imgs_flat = imgs.reshape(imgs.shape[0], -1)
+
+        #train models for all concerned methods and stor them in a dict
+        methods = {}
+        for method_name in method_names:
+            if method_name == "VAE":
+                methods["VAE"] = self.model
+
+            elif method_name == "PCA":
+                self.logger.info("Training PCA...")
+                latent_dim = self.model.latent_dim
+                size = min(5000, len(imgs_flat))
+                if self.use_wandb:
+                    wandb.config["PCA_training_size"] = size
+                idx = np.random.choice(len(imgs_flat), size=size, replace=False)
+                #not enough memory for full dataset -> random subset without duplicates
+                imgs_pca = torch.as_tensor(imgs_flat[idx], dtype=torch.float32, device=self.device)
+                #randomized low rank PCA on the device, slightly overestimating the rank
+                mean = imgs_pca.mean(0)
+                q = min(latent_dim + 10, *imgs_pca.shape)
+                _, S, V = pca_lowrank(imgs_pca - mean, q=q, center=False, niter=2)
+                #whiten as `decomposition.PCA(whiten=True)`: divide by the std of every component
+                S_whiten = S[:latent_dim] / math.sqrt(size - 1)
+                methods["PCA"] = mean, V[:, :latent_dim] / S_whiten
+                self.logger.info("Done")
+
+            elif method_name == "ICA":
+                self.logger.info("Training ICA...")
+                ica = decomposition.FastICA(n_components=self.model.latent_dim)
+                size = min(1000, len(imgs_flat))
+                if self.use_wandb:
+                    wandb.config["ICA_training_size"] = size
+                idx = np.random.choice(len(imgs_flat), size=size, replace=False)
+                #not enough memory for full dataset -> random subset without duplicates
+                ica.fit(imgs_flat[idx])
+                #`ica.transform` is linear: keep its mean and unmixing matrix (which includes
+                #the whitening) on the device to apply it as a single matmul
+                methods["ICA"] = (torch.as_tensor(ica.mean_, dtype=torch.float32, device=self.device),
+                                  torch.as_tensor(ica.components_.T, dtype=torch.float32, device=self.device))
+                self.logger.info("Done")
 
-        res = {}
-        #calculate the expectation values of the normal distributions in the latent representation for the given images
-        for method in methods.keys():
-            if method == "VAE":
-                with torch.no_grad():
-                    mu1, _ = self.model.encoder(imgs_sampled1.to(self.device))
-                    mu2, _ = self.model.encoder(imgs_sampled2.to(self.device))  
-            elif method == "PCA":
-                pca = methods[method]
-                #flatten images
-                imgs_sampled_pca1 = torch.reshape(imgs_sampled1, (imgs_sampled1.shape[0], imgs_sampled1.shape[2]**2))
-                imgs_sampled_pca2 = torch.reshape(imgs_sampled2, (imgs_sampled2.shape[0], imgs_sampled2.shape[2]**2))
-                
-                mu1 = torch.from_numpy(pca.transform(imgs_sampled_pca1)).float()
-                mu2 = torch.from_numpy(pca.transform(imgs_sampled_pca2)).float()
-
-            elif method == "ICA":
-                ica = methods[method]
-                #flatten images
-                imgs_sampled_ica1 = torch.reshape(imgs_sampled1, (imgs_sampled1.shape[0], imgs_sampled1.shape[2]**2))
-                imgs_sampled_ica2 = torch.reshape(imgs_sampled2, (imgs_sampled2.shape[0], imgs_sampled2.shape[2]**2))
-                
-                mu1 = torch.from_numpy(ica.transform(imgs_sampled_ica1)).float()
-                mu2 = torch.from_numpy(ica.transform(imgs_sampled_ica2)).float()
-                
             else: 
-                raise ValueError("Unknown method : {}".format(method)) 
+                raise ValueError("Unknown method : {}".format(method_name))
 
-            z_diff = torch.abs(torch.sub(mu1, mu2))
-            z_diff_b = torch.mean(z_diff, 0)
-            res[method] = z_diff_b, torch.from_numpy(y)
+        return methods
 
-        return res
+    def _compute_z_b_diff_y(self, methods, sample_size, lat_sizes, imgs, n_points=1, batch_size=4096):
+        """
+        Compute the disentanglement metric score as proposed in the original paper
+        reference: https://github.com/deepmind/dsprites-dataset/blob/master/dsprites_reloading_example.ipynb
 
-    def _images_from_data_gen(self, sample_size, lat_sizes, imgs):
+        Parameters
+        ----------
+        imgs: torch.Tensor
+            Images of the dataset, ordered by their factors of variation. Shape
+            (len_dataset, height, width).
 
-        #sample random latent factor that is to be kept fixed
-        y = np.random.randint(lat_sizes.size, size=1)
-        y_lat = np.random.randint(lat_sizes[y], size=sample_size)
+        n_points: int, optional
+            Number of data points (z_diff_b, y) to generate for every method.
 
-        #sample to sets of data generative factors such that the yth value is the same accross the two sets
-        samples1 = np.zeros((sample_size, lat_sizes.size))
-        samples2 = np.zeros((sample_size, lat_sizes.size))
+        batch_size: int, optional
+            Maximum number of images to encode at once. As many pairs of image
+            sets as fit in a batch are encoded together.
 
-        for i, lat_size in enumerate(lat_sizes):
-            samples1[:, i] = y_lat if i == y else np.random.randint(lat_size, size=sample_size) 
-            samples2[:, i] = y_lat if i == y else np.random.randint(lat_size, size=sample_size)
+        Return
+        ------
+        res: dict
+            Maps every method to a tuple (z_diff_b, y) of shape (n_points, latent_dim)
+            and (n_points,). The labels `y` are the same tensor for every method.
+        """
+        latent_dim = self.model.latent_dim
+        #sample random latent factor that is to be kept fixed for every point, labels are shared by all methods
+        y = np.random.randint(lat_sizes.size, size=n_points)
+        y_labels = torch.from_numpy(y).to(self.device)
+        res = {method: (torch.empty(n_points, latent_dim, device=self.device), y_labels)
+               for method in methods}
 
+        #maps factors of variation to the index of the corresponding image
         latents_bases = np.concatenate((lat_sizes[::-1].cumprod()[::-1][1:],
-                                np.array([1,])))
+                                        np.array([1,])))
+
+        n_per_batch = max(1, batch_size // sample_size)
+        for start in range(0, n_points, n_per_batch):
+            n_batch = min(n_per_batch, n_points - start)
+            idcs = slice(start, start + n_batch)
+            latent_indices1, latent_indices2 = self._images_from_data_gen(sample_size, lat_sizes,
+                                                                          latents_bases, y[idcs])
+
+            #use the data generative factors to simulate two sets of images from the dataset
+            #only the gathered images are moved to the device and converted to float
+            imgs_sampled1 = imgs.index_select(0, latent_indices1).to(self.device).unsqueeze_(1).float()
+            imgs_sampled2 = imgs.index_select(0, latent_indices2).to(self.device).unsqueeze_(1).float()
+
+            #calculate the expectation values of the normal distributions in the latent representation for the given images
+            #the results are written in place to `res`, which stays a normal tensor usable by autograd
+            with torch.inference_mode():
+                for method in methods.keys():
+                    if method == "VAE":
+                        mu1, _ = self.model.encoder(imgs_sampled1)
+                        mu2, _ = self.model.encoder(imgs_sampled2)
+                    elif method in ("PCA", "ICA"):
+                        mean, components = methods[method]
+                        #flatten images
+                        imgs_sampled_flat1 = imgs_sampled1.view(imgs_sampled1.size(0), -1)
+                        imgs_sampled_flat2 = imgs_sampled2.view(imgs_sampled2.size(0), -1)
+
+                        mu1 = (imgs_sampled_flat1 - mean) @ components
+                        mu2 = (imgs_sampled_flat2 - mean) @ components
+
+                    else:
+                        raise ValueError("Unknown method : {}".format(method))
+
+                    #average the absolute differences over the sample_size images of every pair
+                    z_diff = torch.abs(torch.sub(mu1, mu2)).view(n_batch, sample_size, latent_dim)
+                    z_diff_b, _ = res[method]
+                    z_diff_b[idcs] = torch.mean(z_diff, 1)
+
+        return res
+
+    def _images_from_data_gen(self, sample_size, lat_sizes, latents_bases, y):
+        """Sample `len(y)` pairs of image sets of size `sample_size`, where both
+        sets of a pair share the value of the factor of variation `y`.
+
+        Parameters
+        ----------
+        y: np.ndarray
+            Index of the fixed factor of variation of every pair. Shape (n_points,).
 
-        latent_indices1 = np.dot(samples1, latents_bases).astype(int)
-        latent_indices2 = np.dot(samples2, latents_bases).astype(int)
+        Return
+        ------
+        latent_indices1, latent_indices2: torch.Tensor
+            Dataset indices of the sampled images. Shape (n_points * sample_size,),
+            the sets of consecutive pairs being stacked.
+        """
+        n_points = len(y)
 
-        #use the data generative factors to simulate two sets of images from the dataset
-        imgs_sampled1 = torch.from_numpy(imgs[latent_indices1]).unsqueeze_(1).float()
-        imgs_sampled2 = torch.from_numpy(imgs[latent_indices2]).unsqueeze_(1).float()
+        #sample to sets of data generative factors such that the yth value is the same accross the two sets
+        #the upper bounds `lat_sizes` broadcast over the last dimension
+        size = (n_points, sample_size, lat_sizes.size)
+        samples1 = np.random.randint(lat_sizes, size=size)
+        samples2 = np.random.randint(lat_sizes, size=size)
+
+        pairs = np.arange(n_points)
+        samples2[pairs, :, y] = samples1[pairs, :, y]
 
-        return imgs_sampled1, imgs_sampled2, y
+        latent_indices1 = torch.from_numpy(np.dot(samples1, latents_bases).astype(np.int64).ravel())
+        latent_indices2 = torch.from_numpy(np.dot(samples2, latents_bases).astype(np.int64).ravel())
 
+        return latent_indices1, latent_indices2
 
     def _mutual_information_gap(self, sorted_mut_info, lat_sizes, storer=None):
         """Compute the mutual information gap as in [1].
@@ -414,23 +505,32 @@ class Evaluator:
         params_zCX: tuple of torch.Tensor
             Sufficient statistics q(z|x) for each training example. E.g. for
             gaussian (mean, log_var) each of shape : (len_dataset, latent_dim).
+
+        Note
+        ----
+        - stored in half precision to halve the memory of the entropy estimation,
+          which upcasts every tile it reads.
+        - on CUDA the next batch is copied on a separate stream while the current
+          one is encoded. The copies are only asynchronous if the dataloader uses
+          `pin_memory=True`.
         """
         len_dataset = len(dataloader.dataset)
         latent_dim = self.model.latent_dim
         n_suff_stat = 2
 
-        q_zCx = torch.zeros(len_dataset, latent_dim, n_suff_stat, device=self.device)
+        q_zCx = torch.empty(len_dataset, latent_dim, n_suff_stat, device=self.device,
+                            dtype=torch.float16)
 
         n = 0
-        with torch.no_grad():
-            for x, label in dataloader:
+        with torch.inference_mode():
+            for x, label in CUDAPrefetcher(dataloader, self.device):
                 batch_size = x.size(0)
                 idcs = slice(n, n + batch_size)
-                q_zCx[idcs, :, 0], q_zCx[idcs, :, 1] = self.model.encoder(x.to(self.device))
+                q_zCx[idcs, :, 0], q_zCx[idcs, :, 1] = self.model.encoder(x)
                 n += batch_size
 
-        params_zCX = q_zCx.unbind(-1)
-        samples_zCx = self.model.reparameterize(*params_zCX)
+            params_zCX = q_zCx.unbind(-1)
+            samples_zCx = self.model.reparameterize(*params_zCX)
 
         return samples_zCx, params_zCX
 
@@ -449,11 +549,13 @@ class Evaluator:
         ----------
         samples_zCx: torch.tensor
             Tensor of shape (len_dataset, latent_dim) containing a sample of
-            q(z|x) for every x in the dataset.
+            q(z|x) for every x in the dataset. Can have additional leading
+            dimensions, in which case the entropies of every independent dataset
+            of shape (len_dataset, latent_dim) are estimated at once.
 
         params_zCX: tuple of torch.Tensor
             Sufficient statistics q(z|x) for each training example. E.g. for
-            gaussian (mean, log_var) each of shape : (len_dataset, latent_dim).
+            gaussian (mean, log_var) each of the same shape as `samples_zCx`.
 
         n_samples: int, optional
             Number of samples to use to estimate the entropies.
@@ -461,61 +563,75 @@ class Evaluator:
         Return
         ------
         H_z: torch.Tensor
-            Tensor of shape (latent_dim) containing the marginal entropies H(z_j)
+            Tensor of shape (*, latent_dim) containing the marginal entropies H(z_j)
         """
-        len_dataset, latent_dim = samples_zCx.shape
+        *batch_shape, len_dataset, latent_dim = samples_zCx.shape
         device = samples_zCx.device
-        H_z = torch.zeros(latent_dim, device=device)
+        n_samples = min(n_samples, len_dataset)
+        # flatten the leading dimensions to a single batch dimension
+        samples_zCx = samples_zCx.reshape(-1, len_dataset, latent_dim)
+        mean, log_var = (p.reshape(-1, len_dataset, latent_dim) for p in params_zCX)
+        batch_size = samples_zCx.size(0)
+        H_z = torch.zeros(batch_size, latent_dim, device=device)
 
         # sample from p(x)
         samples_x = torch.randperm(len_dataset, device=device)[:n_samples]
         # sample from p(z|x)
-        samples_zCx = samples_zCx.index_select(0, samples_x).view(latent_dim, n_samples)
+        samples_zCx = samples_zCx.index_select(1, samples_x).float().view(batch_size, latent_dim, n_samples)
 
-        mini_batch_size = 10
-        samples_zCx = samples_zCx.expand(len_dataset, latent_dim, n_samples)
-        mean = params_zCX[0].unsqueeze(-1).expand(len_dataset, latent_dim, n_samples)
-        log_var = params_zCX[1].unsqueeze(-1).expand(len_dataset, latent_dim, n_samples)
+        mini_batch_size = 100
+        # keeps the size of the tiles constant whatever the batch size
+        dataset_batch_size = max(1, 10000 // batch_size)
         log_N = math.log(len_dataset)
+        # running max and sum of exp(. - max) of the streamed logsumexp over x_n,
+        # allocated once and updated in place for every mini batch of samples
+        max_log_q_buffer = torch.empty(batch_size, latent_dim, mini_batch_size, device=device)
+        sum_exp_buffer = torch.empty_like(max_log_q_buffer)
         with trange(n_samples, leave=False, disable=self.is_progress_bar) as t:
             for k in range(0, n_samples, mini_batch_size):
-                # log q(z_j|x) for n_samples
-                idcs = slice(k, k + mini_batch_size)
-                log_q_zCx = log_density_gaussian(samples_zCx[..., idcs],
-                                                 mean[..., idcs],
-                                                 log_var[..., idcs])
+                # contiguous so that the mini batch (reduced last) is the innermost dimension
+                samples_batch = samples_zCx[..., k:k + mini_batch_size].contiguous()
+                n_batch = samples_batch.size(-1)
+                max_log_q = max_log_q_buffer[..., :n_batch].fill_(-float("inf"))
+                sum_exp = sum_exp_buffer[..., :n_batch].zero_()
+                samples_batch = samples_batch.unsqueeze(1)
+                # tile over the dataset instead of expanding to (len_dataset, latent_dim, n_samples)
+                for d in range(0, len_dataset, dataset_batch_size):
+                    # upcast the tile in case the parameters are stored in lower precision
+                    mean_batch = mean[:, d:d + dataset_batch_size].float().unsqueeze(-1)
+                    log_var_batch = log_var[:, d:d + dataset_batch_size].float().unsqueeze(-1)
+                    # accumulates log q(z_j|x_n) of the mini batch of samples for the tile of x_n
+                    self._logsumexp_gaussian_step(samples_batch, mean_batch, log_var_batch, max_log_q, sum_exp, 1)
                 # numerically stable log q(z_j) for n_samples:
                 # log q(z_j) = -log N + logsumexp_{n=1}^N log q(z_j|x_n)
                 # As we don't know q(z) we appoximate it with the monte carlo
                 # expectation of q(z_j|x_n) over x. => fix a single z and look at
                 # proba for every x to generate it. n_samples is not used here !
-                log_q_z = -log_N + torch.logsumexp(log_q_zCx, dim=0, keepdim=False)
+                log_q_z = sum_exp.log_().add_(max_log_q).sub_(log_N)
                 # H(z_j) = E_{z_j}[- log q(z_j)]
-                # mean over n_samples (i.e. dimesnion 1 because already summed over 0).
-                H_z += (-log_q_z).sum(1)
+                # mean over n_samples (i.e. last dimension because already summed over the dataset).
+                H_z -= log_q_z.sum(-1)
 
-                t.update(mini_batch_size)
+                t.update(n_batch)
 
         H_z /= n_samples
 
-        return H_z
+        return H_z.view(*batch_shape, latent_dim)
 
     def _estimate_H_zCv(self, samples_zCx, params_zCx, lat_sizes, lat_names):
         """Estimate conditional entropies :math:`H[z|v]`."""
         latent_dim = samples_zCx.size(-1)
-        len_dataset = reduce((lambda x, y: x * y), lat_sizes)
+        len_dataset = int(np.prod(lat_sizes))
         H_zCv = torch.zeros(len(lat_sizes), latent_dim, device=self.device)
         for i_fac_var, (lat_size, lat_name) in enumerate(zip(lat_sizes, lat_names)):
-            idcs = [slice(None)] * len(lat_sizes)
-            for i in range(lat_size):
-                self.logger.info("Estimating conditional entropies for the {}th value of {}.".format(i, lat_name))
-                idcs[i_fac_var] = i
-                # samples from q(z,x|v)
-                samples_zxCv = samples_zCx[idcs].contiguous().view(len_dataset // lat_size,
-                                                                   latent_dim)
-                params_zxCv = tuple(p[idcs].contiguous().view(len_dataset // lat_size, latent_dim)
-                                    for p in params_zCx)
-
-                H_zCv[i_fac_var] += self._estimate_latent_entropies(samples_zxCv, params_zxCv
-                                                                    ) / lat_size
+            self.logger.info("Estimating conditional entropies for every value of {}.".format(lat_name))
+            lat_size = int(lat_size)
+            chunk = len_dataset // lat_size
+            # samples from q(z,x|v) for every value of v, stacked along the first dimension
+            samples_zxCv = samples_zCx.movedim(i_fac_var, 0).reshape(lat_size, chunk, latent_dim)
+            params_zxCv = tuple(p.movedim(i_fac_var, 0).reshape(lat_size, chunk, latent_dim)
+                                for p in params_zCx)
+
+            # average over the values of v
+            H_zCv[i_fac_var] = self._estimate_latent_entropies(samples_zxCv, params_zxCv).mean(0)
         return H_zCv
@@ -78,7 +78,8 @@ class DecoderBurgess(nn.Module):
             x = torch.relu(self.convT_64(x))
         x = torch.relu(self.convT1(x))
         x = torch.relu(self.convT2(x))
-        # Sigmoid activation for final conv layer
-        x = torch.sigmoid(self.convT3(x))
+        # Sigmoid activation for final conv layer, in full precision even under
+        # autocast so that probabilities do not round to exactly 0 or 1
+        x = torch.sigmoid(self.convT3(x).float())
 
         return x
@@ -77,7 +77,8 @@ class EncoderBurgess(nn.Module):
             x = torch.relu(self.conv_64(x))
 
         # Fully connected layers with ReLu activations
-        x = x.view((batch_size, -1))
+        # reshape as the convolutions may output channels last tensors
+        x = x.reshape((batch_size, -1))
         x = torch.relu(self.lin1(x))
         x = torch.relu(self.lin2(x))
 
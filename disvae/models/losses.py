@@ -278,7 +278,7 @@ class FactorKLoss(BaseLoss):
             return vae_loss
 
         # Compute VAE gradients
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         vae_loss.backward(retain_graph=True)
 
         # Discriminator Loss
@@ -300,7 +300,7 @@ class FactorKLoss(BaseLoss):
         #d_tc_loss = anneal_reg * d_tc_loss
 
         # Compute discriminator gradients
-        self.optimizer_d.zero_grad()
+        self.optimizer_d.zero_grad(set_to_none=True)
         d_tc_loss.backward()
 
         # Update at the end (since pytorch 1.5. complains if update before)
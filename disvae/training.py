@@ -9,9 +9,12 @@ import torch
 from torch.nn import functional as F
 
 from disvae.utils.modelIO import save_model
+from disvae.utils.prefetch import CUDAPrefetcher
 
 
 TRAIN_LOSSES_LOGFILE = "train_losses.log"
+# number of iterations between updates of the progress bar loss, which synchronize with the device
+PROGRESS_BAR_EVERY = 10
 
 
 class Trainer():
@@ -41,6 +44,22 @@ class Trainer():
 
     is_progress_bar: bool, optional
         Whether to use a progress bar for training.
+
+    accumulation_steps: int, optional
+        Number of batches over which to accumulate the gradients before every
+        optimizer step, i.e. the effective batch size is `accumulation_steps`
+        times the batch size of the data loader. Not supported by losses that
+        optimize themselves (e.g. Factor), which step at every batch.
+
+    is_amp: bool, optional
+        Whether to run the forward pass in mixed precision with scaled gradients
+        when training on CUDA. Losses that optimize themselves (e.g. Factor) are
+        always trained in full precision.
+
+    is_compile: bool, optional
+        Whether to compile the forward pass of the model with `torch.compile`
+        when training on CUDA. Disable it for debugging. CUDA graphs are only
+        used without gradient accumulation.
     """
 
     def __init__(self, model, optimizer, loss_f,
@@ -48,10 +67,16 @@ class Trainer():
                  logger=logging.getLogger(__name__),
                  save_dir="results",
                  gif_visualizer=None,
-                 is_progress_bar=True):
+                 is_progress_bar=True,
+                 accumulation_steps=1,
+                 is_amp=True,
+                 is_compile=True):
 
         self.device = device
-        self.model = model.to(self.device)
+        # on CUDA, cuDNN convolutions are faster on NHWC (channels last) images
+        self.memory_format = (torch.channels_last if self.device.type == "cuda"
+                              else torch.contiguous_format)
+        self.model = model.to(self.device, memory_format=self.memory_format)
         self.loss_f = loss_f
         self.optimizer = optimizer
         self.save_dir = save_dir
@@ -59,7 +84,22 @@ class Trainer():
         self.logger = logger
         self.losses_logger = LossesLogger(os.path.join(self.save_dir, TRAIN_LOSSES_LOGFILE))
         self.gif_visualizer = gif_visualizer
+        if accumulation_steps < 1:
+            raise ValueError("accumulation_steps should be at least 1 but got {}.".format(accumulation_steps))
+        self.accumulation_steps = accumulation_steps
+        self.is_compile = (is_compile and self.device.type == "cuda" and
+                           hasattr(self.model, "compile"))
+        if self.is_compile:
+            # CUDA graphs free the gradients they output at the next forward, so they cannot
+            # be accumulated over several batches
+            mode = "reduce-overhead" if self.accumulation_steps == 1 else "default"
+            # compiles in place, so the parameters and the `state_dict` keys are unchanged
+            self.model.compile(mode=mode)
+        self.is_amp = is_amp and self.device.type == "cuda"
+        self.scaler = torch.amp.GradScaler("cuda", enabled=self.is_amp)
         self.logger.info("Training Device: {}".format(self.device))
+        if self.accumulation_steps > 1 and hasattr(self.loss_f, "call_optimize"):
+            self.logger.warning("Gradient accumulation is not supported by {}: stepping at every batch.".format(type(self.loss_f).__name__))
 
     def __call__(self, data_loader,
                  epochs=10,
@@ -78,9 +118,15 @@ class Trainer():
             Save a checkpoint of the trained model every n epoch.
         """
         start = default_timer()
+        if self.device.type == "cuda" and not data_loader.pin_memory:
+            self.logger.warning("The data loader does not pin memory: host to device copies will be synchronous.")
+        if data_loader.num_workers == 0:
+            self.logger.warning("The data loader has num_workers=0: loading batches will be serialized with training.")
+        elif epochs > 1 and not data_loader.persistent_workers:
+            self.logger.warning("The data loader does not use persistent_workers: workers will be restarted every epoch.")
         self.model.train()
         for epoch in range(epochs):
-            storer = defaultdict(list)
+            storer = defaultdict(RunningMean)
             mean_epoch_loss = self._train_epoch(data_loader, storer, epoch)
             self.logger.info('Epoch: {} Average loss per image: {:.2f}'.format(epoch + 1,
                                                                                mean_epoch_loss))
@@ -120,48 +166,77 @@ class Trainer():
         mean_epoch_loss: float
             Mean loss per image
         """
-        epoch_loss = 0.
+        n_batches = len(data_loader)
+        # summed on the device to only synchronize when displaying the loss
+        epoch_loss = torch.zeros((), device=self.device)
+        recent_loss = torch.zeros((), device=self.device)
         kwargs = dict(desc="Epoch {}".format(epoch + 1), leave=False,
                       disable=not self.is_progress_bar)
-        with trange(len(data_loader), **kwargs) as t:
-            for _, (data, _) in enumerate(data_loader):
-                iter_loss = self._train_iteration(data, storer)
+        with trange(n_batches, **kwargs) as t:
+            # the next batch is copied to the device while training on the current one
+            for step, (data, _) in enumerate(CUDAPrefetcher(data_loader, self.device)):
+                is_step = ((step + 1) % self.accumulation_steps == 0 or
+                           step + 1 == n_batches)
+                iter_loss = self._train_iteration(data, storer, is_step=is_step)
                 epoch_loss += iter_loss
+                recent_loss += iter_loss
 
-                t.set_postfix(loss=iter_loss)
+                if (step + 1) % PROGRESS_BAR_EVERY == 0 or step + 1 == n_batches:
+                    n_recent = step % PROGRESS_BAR_EVERY + 1
+                    t.set_postfix(loss=recent_loss.item() / n_recent)
+                    recent_loss.zero_()
                 t.update()
 
-        mean_epoch_loss = epoch_loss / len(data_loader)
+        mean_epoch_loss = epoch_loss.item() / n_batches
         return mean_epoch_loss
 
-    def _train_iteration(self, data, storer):
+    def _train_iteration(self, data, storer, is_step=True):
         """
         Trains the model for one iteration on a batch of data.
 
         Parameters
         ----------
         data: torch.Tensor
-            A batch of data. Shape : (batch_size, channel, height, width).
+            A batch of data, already on `self.device`. Shape : (batch_size, channel, height, width).
 
         storer: dict
             Dictionary in which to store important variables for vizualisation.
+
+        is_step: bool, optional
+            Whether to update the parameters with the gradients accumulated since
+            the last update.
+
+        Return
+        ------
+        loss: torch.Tensor
+            Detached loss of the batch, left on the device to avoid a synchronization.
         """
-        batch_size, channel, height, width = data.size()
-        data = data.to(self.device)
+        if data.dim() == 4:
+            data = data.contiguous(memory_format=self.memory_format)
 
         try:
-            recon_batch, latent_dist, latent_sample = self.model(data)
+            with torch.autocast(self.device.type, enabled=self.is_amp):
+                recon_batch, latent_dist, latent_sample = self.model(data)
+
+            # the losses (e.g. binary cross entropy, KL) are computed in full precision. The
+            # decoder already outputs fp32 probabilities as the fp16 sigmoid saturates
+            if self.is_amp:
+                latent_sample = latent_sample.float()
+                latent_dist = tuple(stat.float() for stat in latent_dist)
             loss = self.loss_f(data, recon_batch, latent_dist, self.model.training,
                                storer, latent_sample=latent_sample)
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            # average the gradients of the accumulated batches
+            self.scaler.scale(loss / self.accumulation_steps).backward()
+            if is_step:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
 
         except ValueError:
             # for losses that use multiple optimizers (e.g. Factor)
             loss = self.loss_f.call_optimize(data, self.model, self.optimizer, storer)
 
-        return loss.item()
+        return loss.detach()
 
 
 class LossesLogger(object):
@@ -186,11 +261,24 @@ class LossesLogger(object):
     def log(self, epoch, losses_storer):
         """Write to the log file """
         for k, v in losses_storer.items():
-            log_string = ",".join(str(item) for item in [epoch, k, mean(v)])
+            log_string = ",".join(str(item) for item in [epoch, k, v.mean()])
             self.logger.debug(log_string)
 
 
-# HELPERS
-def mean(l):
-    """Compute the mean of a list"""
-    return sum(l) / len(l)
+class RunningMean(object):
+    """Running mean of the values appended to it. Only stores their sum and count,
+    so it can replace the lists of a losses storer.
+    """
+
+    def __init__(self):
+        self.sum = 0.
+        self.count = 0
+
+    def append(self, value):
+        """Add a value to the mean."""
+        self.sum += value
+        self.count += 1
+
+    def mean(self):
+        """Compute the mean of the appended values."""
+        return self.sum / self.count
@@ -4,6 +4,8 @@ import math
 from tqdm import trange, tqdm
 import torch
 
+LOG_2PI = math.log(2 * math.pi)
+
 
 def matrix_log_density_gaussian(x, mu, logvar):
     """Calculates log density of a Gaussian for all combination of bacth pairs of
@@ -45,12 +47,50 @@ def log_density_gaussian(x, mu, logvar):
     logvar: torch.Tensor or np.ndarray or float
         Log variance.
     """
-    normalization = - 0.5 * (math.log(2 * math.pi) + logvar)
+    normalization = - 0.5 * (LOG_2PI + logvar)
     inv_var = torch.exp(-logvar)
     log_density = normalization - 0.5 * ((x - mu)**2 * inv_var)
     return log_density
 
 
+def logsumexp_gaussian_step(x, mu, logvar, running_max, running_sum, dim):
+    """Updates a streamed logsumexp over dimension `dim` of the log density of a
+    Gaussian with a new tile of `mu` and `logvar`. The density is computed in place
+    in a single buffer, and `running_max` and `running_sum` are updated in place
+    and returned. Can be wrapped in `torch.compile` to fuse it.
+
+    Parameters
+    ----------
+    x: torch.Tensor
+        Value at which to compute the density. Broadcastable with `mu`.
+
+    mu: torch.Tensor
+        Mean of the tile.
+
+    logvar: torch.Tensor
+        Log variance of the tile.
+
+    running_max: torch.Tensor
+        Running maximum of the log densities. Shape of the log densities without `dim`.
+
+    running_sum: torch.Tensor
+        Running sum of `exp(log_density - running_max)`. Same shape as `running_max`.
+
+    dim: int
+        Dimension to reduce.
+    """
+    # -0.5 * ((x - mu)**2 / var + logvar + log(2 pi)) computed in place in a single buffer
+    log_density = x - mu
+    log_density.mul_(log_density).mul_(torch.exp(-logvar))
+    log_density.add_(logvar).add_(LOG_2PI).mul_(-0.5)
+    new_max = torch.max(running_max, log_density.amax(dim))
+    # rescale the previous sum to the new max, then add the tile
+    running_sum.mul_(running_max.sub_(new_max).exp_())
+    running_sum.add_(log_density.sub_(new_max.unsqueeze(dim)).exp_().sum(dim))
+    running_max.copy_(new_max)
+    return running_max, running_sum
+
+
 def log_importance_weight_matrix(batch_size, dataset_size):
     """
     Calculates a log importance weight matrix
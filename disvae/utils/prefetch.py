@@ -0,0 +1,67 @@
+import torch
+
+
+class CUDAPrefetcher(object):
+    """Iterates over a data loader, copying the next batch to the device on a
+    separate CUDA stream while the current one is being used. On CPU the batches
+    are simply moved to the device.
+
+    Parameters
+    ----------
+    data_loader: torch.utils.data.DataLoader
+        Data loader returning tensors or tuples of tensors. Copies only overlap
+        with compute if it uses `pin_memory=True`.
+
+    device: torch.device
+        Device to which to copy the batches.
+    """
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        batches = iter(self.data_loader)
+        next_batch = self._preload(batches)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                # wait for the copy of the current batch, and keep its memory alive
+                # until the compute stream is done with it
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for tensor in _as_tuple(batch):
+                    tensor.record_stream(current_stream)
+
+            # double buffering: start copying the next batch before using this one
+            next_batch = self._preload(batches)
+            yield batch
+
+    def _preload(self, batches):
+        """Start copying the next batch to the device, `None` if exhausted."""
+        batch = next(batches, None)
+        if batch is None:
+            return None
+
+        if self.stream is None:
+            return _to_device(batch, self.device)
+
+        with torch.cuda.stream(self.stream):
+            return _to_device(batch, self.device, non_blocking=True)
+
+
+# HELPERS
+def _as_tuple(batch):
+    """Return the tensors of a batch as a tuple."""
+    return (batch,) if isinstance(batch, torch.Tensor) else tuple(batch)
+
+
+def _to_device(batch, device, **kwargs):
+    """Move a tensor or a sequence of tensors to `device`."""
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, **kwargs)
+    return type(batch)(tensor.to(device, **kwargs) for tensor in batch)
@@ -51,6 +51,12 @@ def parse_arguments(args_to_parse):
     general.add_argument('--no-cuda', action='store_true',
                          default=default_config['no_cuda'],
                          help='Disables CUDA training, even when have one.')
+    general.add_argument('--no-amp', action='store_true',
+                         default=default_config['no_amp'],
+                         help='Disables mixed precision training on CUDA.')
+    general.add_argument('--no-compile', action='store_true',
+                         default=default_config['no_compile'],
+                         help='Disables compiling the model for CUDA training and the metric classifier for CUDA evaluation.')
     general.add_argument('-s', '--seed', type=int, default=default_config['seed'],
                          help='Random seed. Can be `None` for stochastic behavior.')
 
@@ -72,6 +78,9 @@ def parse_arguments(args_to_parse):
                           help='Batch size for training.')
     training.add_argument('--lr', type=float, default=default_config['lr'],
                           help='Learning rate.')
+    training.add_argument('--accumulation-steps', type=int,
+                          default=default_config['accumulation_steps'],
+                          help='Number of batches over which to accumulate gradients before every optimizer step.')
 
     # Model Options
     model = parser.add_argument_group('Model specfic options')
@@ -219,7 +228,10 @@ def main(args):
                           logger=logger,
                           save_dir=exp_dir,
                           is_progress_bar=not args.no_progress_bar,
-                          gif_visualizer=gif_visualizer)
+                          gif_visualizer=gif_visualizer,
+                          accumulation_steps=args.accumulation_steps,
+                          is_amp=not args.no_amp,
+                          is_compile=not args.no_compile)
         trainer(train_loader,
                 epochs=args.epochs,
                 checkpoint_every=args.checkpoint_every,)
@@ -255,7 +267,8 @@ def main(args):
                               device=device,
                               logger=logger,
                               save_dir=exp_dir,
-                              is_progress_bar=not args.no_progress_bar, use_wandb = use_wandb)
+                              is_progress_bar=not args.no_progress_bar, use_wandb = use_wandb,
+                              is_compile=not args.no_compile)
 
         evaluator(test_loader, is_metrics=args.is_metrics, is_losses=not args.no_test)
 